@@ -1,29 +1,86 @@
 import time
-import operator
 import numpy as np
 from keras.utils import np_utils
+from scipy.linalg.blas import sgemm
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
 
-def initialize_parameters(layer_dims):
+def count_parameters(layer_dims):
     """
     :param layer_dims: an array of the dimensions of each layer in the network
-    (layer 0 is the size of the flattened input, layer L is the output softmax)
-    :return: a dictionary containing the initialized W and b parameters of
-    each layer (W1…WL, b1…bL).
+    :return: the total number of W and b values in the network
+    """
+    return sum(layer_dims[l] * (layer_dims[l - 1] + 1) for l in range(1, len(layer_dims)))
+
+
+def parameter_views(flat_buffer, layer_dims):
     """
-    parameters = {}
+    Splits a flat buffer into per-layer W and b views (no data is copied), so
+    that all parameters (or gradients) sit contiguously in memory.
+    :param flat_buffer: a 1-D array of count_parameters(layer_dims) values
+    :param layer_dims: an array of the dimensions of each layer in the network
+    :return: a tuple (Ws, bs) of two lists of views into flat_buffer
+    """
+    Ws = []
+    bs = []
+    offset = 0
     for current_layer in range(1, len(layer_dims)):
-        parameters[current_layer] = [np.random.randn(layer_dims[current_layer],
-                                                     layer_dims[current_layer - 1]) * np.sqrt(2 / layer_dims[current_layer]),
-                                     np.zeros((layer_dims[current_layer], 1))]
+        rows, cols = layer_dims[current_layer], layer_dims[current_layer - 1]
+        # Fortran order lets BLAS read both W and W.T without a copy
+        Ws.append(flat_buffer[offset:offset + rows * cols].reshape((rows, cols), order='F'))
+        offset += rows * cols
+        bs.append(flat_buffer[offset:offset + rows].reshape((rows, 1)))
+        offset += rows
+    return Ws, bs
 
-    return parameters
 
+def initialize_parameters(layer_dims, params_buffer=None):
+    """
+    :param layer_dims: an array of the dimensions of each layer in the network
+    (layer 0 is the size of the flattened input, layer L is the output softmax)
+    :param params_buffer: optional flat float32 buffer of
+    count_parameters(layer_dims) values to hold the parameters
+    :return: a tuple (Ws, bs) of two lists holding the initialized W and b
+    parameters of each layer (Ws[0]…Ws[L-1], bs[0]…bs[L-1]), as views into
+    a single flat buffer.
+    """
+    if params_buffer is None:
+        params_buffer = np.empty(count_parameters(layer_dims), dtype=np.float32)
+    Ws, bs = parameter_views(params_buffer, layer_dims)
+    for current_layer in range(1, len(layer_dims)):
+        Ws[current_layer - 1][...] = np.random.randn(layer_dims[current_layer], layer_dims[current_layer - 1]) \
+            * np.sqrt(2 / layer_dims[current_layer])
+        bs[current_layer - 1][...] = 0
+
+    return Ws, bs
 
-def linear_forward(A, W, b):
+
+def initialize_buffers(layer_dims, n_examples, with_gradients=True):
+    """
+    Preallocates the per-layer arrays of a forward (and backward) pass so they
+    can be reused between batches instead of being allocated on every step.
+    :param layer_dims: an array of the dimensions of each layer in the network
+    :param n_examples: the number of examples in every batch using the buffers
+    :param with_gradients: whether to allocate the backward propagation buffers
+    :return: a dictionary of lists indexed by layer (0…L-1):
+    "Z" – the linear output / activations of each layer
+    "dA_prev", "dW", "db" – the gradients computed by Linear_backward
+    "grads" – a flat buffer that the "dW" and "db" arrays are views into
+    """
+    layers = range(1, len(layer_dims))
+    buffers = {"Z": [np.empty((layer_dims[l], n_examples), dtype=np.float32, order='F') for l in layers]}
+    if with_gradients:
+        # the first layer never needs the gradient with respect to the input X
+        buffers["dA_prev"] = [None] + [np.empty((layer_dims[l - 1], n_examples), dtype=np.float32, order='F')
+                                       for l in layers[1:]]
+        buffers["grads"] = np.zeros(count_parameters(layer_dims), dtype=np.float32)
+        buffers["dW"], buffers["db"] = parameter_views(buffers["grads"], layer_dims)
+    return buffers
+
+
+def linear_forward(A, W, b, out=None):
     """
     Implement the linear part of a layer's forward propagation.
     :param A: the activations of the previous layer
@@ -31,73 +88,93 @@ def linear_forward(A, W, b):
     [size of current layer, size of previous layer])
     :param b: the bias vector of the current layer
     (of shape [size of current layer, 1])
+    :param out: optional preallocated Fortran-ordered array to write Z into
+    (float32 inputs only)
     :return:
     Z – the linear component of the activation function (i.e., the value before
     applying the non-linear function)
     linear_cache – a dictionary containing A, W, b
     (stored for making the backpropagation easier to compute)
     """
-    Z = np.dot(W, A)
-    return Z + b, (A, W, b)
+    # sgemm would silently downcast other dtypes, so only float32 goes to it
+    if W.dtype == np.float32 and A.dtype == np.float32:
+        Z = sgemm(1.0, W, A, c=out, overwrite_c=True)
+    else:
+        Z = np.dot(W, A)
+    Z += b
+    return Z, (A, W, b)
 
 
 def softmax(Z):
     """
-    :param Z: the linear component of the activation function
+    :param Z: the linear component of the activation function, overwritten
+    in place (callers must not reuse it)
     :return: A - the activations of the layer
-    activation_cache – returns Z, which will be useful for the backpropagation
+    activation_cache – returns the same array (softmax_backward only needs Y)
     """
-    e_x = np.exp(np.subtract(Z, np.max(Z, axis=0)))
-    return e_x / e_x.sum(axis=0), Z
+    np.subtract(Z, Z.max(axis=0, keepdims=True), out=Z)
+    np.exp(Z, out=Z)
+    Z /= Z.sum(axis=0, keepdims=True)
+    return Z, Z
 
 
 def relu(Z):
     """
-     :param Z: the linear component of the activation function
+     :param Z: the linear component of the activation function, overwritten
+     in place (callers must not reuse it)
      :return: A - the activations of the layer
      activation_cache – returns Z, which will be useful for the backpropagation
+     (after the in-place ReLU it has the same sign pattern as the original Z)
      """
-    A = np.maximum(0, Z)
-    return A, Z
+    np.maximum(Z, 0, out=Z)
+    return Z, Z
 
 
-def linear_activation_forward(A_prev, W, B, activation, dropout):
+def linear_activation_forward(A_prev, W, B, activation, dropout, out=None):
     """
     Implement the forward propagation for the LINEAR->ACTIVATION layer
     :param A_prev: activations of the previous layer
     :param W: the weights matrix of the current layer
     :param B: the bias vector of the current layer
     :param activation: the activation function to be used
-    (a string, either “softmax” or “relu”)
+    (a string, either “softmax”, “relu” or “linear” for no activation)
+    :param out: optional preallocated array for Z (the activations are
+    computed in place on it)
     :return:
     A – the activations of the current layer
-    cache – a joint dictionary containing both linear_cache and activation_cache
+    cache – a joint list containing linear_cache and activation_cache (and
+    for relu layers the boolean dropout mask, or None without dropout)
     """
-    Z, linear_cache = linear_forward(A_prev, W, B)
+    Z, linear_cache = linear_forward(A_prev, W, B, out)
     if activation == 'relu':
         A, activation_cache = relu(Z)
+        dropout_mask = None
         if dropout < 1:
-            drop_matrix = np.random.rand(A.shape[0], A.shape[1])
-            drop_matrix = (drop_matrix < dropout)
-            A = np.multiply(A, drop_matrix)
-            A = np.divide(A, dropout)
-            dropout_cache = drop_matrix
-            return A, [linear_cache, activation_cache, dropout_cache]
+            dropout_mask = np.random.random_sample(A.shape) < dropout
+            A *= dropout_mask
+            A *= A.dtype.type(1.0 / dropout)
+        return A, [linear_cache, activation_cache, dropout_mask]
     elif activation == 'softmax':
         A, activation_cache = softmax(Z)
+    elif activation == 'linear':
+        A, activation_cache = Z, Z
     return A, [linear_cache, activation_cache]
 
 
-def L_model_forward(X, parameters, use_batchnorm, dropout):
+def L_model_forward(X, parameters, use_batchnorm, dropout, return_logits=False, buffers=None):
     """
     Implement forward propagation for the [LINEAR->RELU]*(L-1)->LINEAR->SOFTMAX
     computation
     :param X: the data, numpy array of shape (input size, number of examples)
-    :param parameters: the initialized W and b parameters of each layer
+    :param parameters: the (Ws, bs) lists of W and b parameters of each layer
     :param use_batchnorm: a boolean flag used to determine whether to apply
     batchnorm after the activation (note that this option needs to be set to “false” in Section 3 and “true” in Section 4).
+    :param return_logits: if True, skip the softmax of the last layer and
+    return its linear output instead
+    :param buffers: optional preallocated arrays (from initialize_buffers,
+    sized for X) that the layer outputs are written into
     :return:
-    AL – the last post-activation value
+    AL – the last post-activation value (or the last layer logits)
     caches – a list of all the cache objects generated by the linear_forward function
 
     use linear_activation_forward function with relu activation function in an
@@ -106,45 +183,52 @@ def L_model_forward(X, parameters, use_batchnorm, dropout):
     for the last layer - use linear_activation_forward with softmax
     activation function.
     """
-    num_of_layers = len(parameters)
+    Ws, bs = parameters
+    Zs = buffers["Z"] if buffers is not None else [None] * len(Ws)
     A = X
     cache_list = []
-    for layer in range(1, num_of_layers):
-        W = parameters[layer][0]
-        B = parameters[layer][1]
+    for W, B, Z in zip(Ws[:-1], bs[:-1], Zs[:-1]):
         A_prev = A
-        A, cache = linear_activation_forward(A_prev, W, B, 'relu', dropout)
+        A, cache = linear_activation_forward(A_prev, W, B, 'relu', dropout, Z)
         if use_batchnorm:
             A = apply_batchnorm(A)
         cache_list.append(cache)
 
-    W = parameters[num_of_layers][0]
-    B = parameters[num_of_layers][1]
     A_prev = A
-    A, cache = linear_activation_forward(A_prev, W, B, 'softmax', dropout)
+    A, cache = linear_activation_forward(A_prev, Ws[-1], bs[-1], 'linear' if return_logits else 'softmax', dropout,
+                                         Zs[-1])
     cache_list.append(cache)
     return A, cache_list
 
 
-def compute_cost(AL, Y):
+def compute_cost(AL, Y, from_logits=False):
     """
     Implement the cost function defined by equation.
     :param AL: probability vector corresponding to your label predictions,
     shape (num_of_classes, number of examples)
     :param Y: the labels vector (i.e. the ground truth).
+    :param from_logits: if True, AL holds the last layer logits instead, and
+    the cost is computed from them with softmax_cross_entropy
     :return: cost – the cross-entropy cost.
     """
+    if from_logits:
+        return softmax_cross_entropy(AL, Y)
 
-    n_classes = AL.shape[0]
-    n_examples = AL.shape[1]
+    return -np.sum(Y * np.log(np.maximum(AL, AL.dtype.type(1e-7)))) / AL.shape[1]
 
-    cost = 0
-    for ex in range(0, n_examples):
-        for cl in range(0, n_classes):
-            if Y[cl][ex] == 1:
-                cost += 1 * np.log(AL[cl][ex])
-    cost /= (-n_examples)
-    return cost
+
+def softmax_cross_entropy(Z, Y):
+    """
+    Computes the cross-entropy cost directly from the logits, as
+    -sum(Y*Z) + sum(logsumexp(Z)), without forming the softmax probabilities.
+    :param Z: the linear output of the last layer,
+    shape (num_of_classes, number of examples)
+    :param Y: the one-hot labels vector (i.e. the ground truth).
+    :return: cost – the cross-entropy cost.
+    """
+    Z_max = Z.max(axis=0, keepdims=True)
+    lse = Z_max + np.log(np.exp(Z - Z_max).sum(axis=0, keepdims=True))
+    return (np.sum(lse) - np.sum(Y * Z)) / Z.shape[1]
 
 
 def apply_batchnorm(A):
@@ -155,14 +239,16 @@ def apply_batchnorm(A):
     learned in class
     """
 
-    sum = np.sum(A, axis=1, keepdims=True)
-    mean = sum / A.shape[1]
-    var = np.sum(np.square(A-mean), axis=1, keepdims=True) / A.shape[1]
-    epsilon = np.finfo(float).eps
-    return np.divide(np.subtract(A, mean), np.sqrt(var+epsilon))
+    mean = A.mean(axis=1, keepdims=True)
+    var = A.var(axis=1, keepdims=True)
+    epsilon = np.finfo(A.dtype).eps
+    inv_std = np.reciprocal(np.sqrt(var + epsilon))
+    NA = A - mean
+    NA *= inv_std
+    return NA
 
 
-def Linear_backward(dZ, cache):
+def Linear_backward(dZ, cache, out=None, need_dA_prev=True):
     """
     Implements the linear part of the backward propagation process for a
     single layer
@@ -170,29 +256,53 @@ def Linear_backward(dZ, cache):
     the current layer (layer l)
     :param cache: tuple of values (A_prev, W, b) coming from the forward
     propagation in the current layer
+    :param out: optional preallocated (dA_prev, dW, db) arrays to write into
+    :param need_dA_prev: whether to compute dA_prev (not needed for the first layer)
     :return:
     dA_prev -- Gradient of the cost with respect to the activation (of the previous layer l-1), same shape as A_prev
+    (None if need_dA_prev is False)
     dW -- Gradient of the cost with respect to W (current layer l), same shape as W
     db -- Gradient of the cost with respect to b (current layer l), same shape as b
     """
     A_prev = cache[0]
     W = cache[1]
-    neurons = cache[2].shape[0]
     samples = A_prev.shape[1]
-
-    dW = np.dot(dZ, A_prev.T) / samples
-    db = np.array([[np.sum(dZ[i]) / samples] for i in range(neurons)])
-    dA_prev = np.dot(W.T, dZ)
+    dA_prev_out, dW_out, db_out = out if out is not None else (None, None, None)
+    use_sgemm = dZ.dtype == np.float32 and A_prev.dtype == np.float32 and W.dtype == np.float32
+
+    if use_sgemm:
+        dW = sgemm(1.0 / samples, dZ, A_prev, trans_b=True, c=dW_out, overwrite_c=True)
+    else:
+        dW = np.dot(dZ, A_prev.T) / samples
+    db = np.sum(dZ, axis=1, keepdims=True, out=db_out)
+    db /= samples
+    dA_prev = None
+    if need_dA_prev:
+        if use_sgemm:
+            dA_prev = sgemm(1.0, W, dZ, trans_a=True, c=dA_prev_out, overwrite_c=True)
+        else:
+            dA_prev = np.dot(W.T, dZ)
+    # f2py silently returns a copy when it cannot write into c (wrong dtype or
+    # layout), which would leave the preallocated gradients stale
+    if (dW_out is not None and dW is not dW_out) or (need_dA_prev and dA_prev_out is not None
+                                                     and dA_prev is not dA_prev_out):
+        raise RuntimeError("the gradients were not written into the preallocated output buffers")
     return dA_prev, dW, db
 
 
-def linear_activation_backward(dA, cache, activation, dropout, dropout_cache):
+def linear_activation_backward(dA, cache, activation, dropout, mask, Y=None, out=None, need_dA_prev=True):
     """
     Implements the backward propagation for the LINEAR->ACTIVATION layer. The
     function first computes dZ and then applies the linear_backward function.
     :param dA: post activation gradient of the current layer
     :param cache: contains both the linear cache and the activations cache
     :param activation: the activation function used (relu/softmax)
+    :param dropout: the keep probability used in the forward propagation
+    :param mask: the dropout mask applied to the activations of the previous
+    layer (None if no dropout was applied to them)
+    :param Y: the true labels vector, used only by the softmax activation
+    :param out: optional preallocated (dA_prev, dW, db) arrays to write into
+    :param need_dA_prev: whether to compute dA_prev (not needed for the first layer)
     :return:
     dA_prev – Gradient of the cost with respect to the activation (of the previous layer l-1), same shape as A_prev
     dW – Gradient of the cost with respect to W (current layer l), same shape as W
@@ -202,14 +312,13 @@ def linear_activation_backward(dA, cache, activation, dropout, dropout_cache):
     activation_cache = cache[1]
     if activation == 'relu':
         dZ = relu_backward(dA, activation_cache)
-        dA_prev, dW, db = Linear_backward(dZ, linear_cache)
+        dA_prev, dW, db = Linear_backward(dZ, linear_cache, out, need_dA_prev)
     elif activation == 'softmax':
-        Y = cache[2]
         dZ = softmax_backward(dA, Y)
-        dA_prev, dW, db = Linear_backward(dZ, linear_cache)
-    if dropout < 1 and bool(dropout_cache):
-        dA_prev = np.multiply(dA_prev, dropout_cache.get("cache"))
-        dA_prev = np.divide(dA_prev, dropout)
+        dA_prev, dW, db = Linear_backward(dZ, linear_cache, out, need_dA_prev)
+    if mask is not None:
+        dA_prev *= mask
+        dA_prev *= dA_prev.dtype.type(1.0 / dropout)
 
     return dA_prev, dW, db
 
@@ -217,13 +326,12 @@ def linear_activation_backward(dA, cache, activation, dropout, dropout_cache):
 def relu_backward(dA, activation_cache):
     """
     Implements backward propagation for a ReLU unit
-    :param dA: the post-activation gradient
+    :param dA: the post-activation gradient, overwritten in place
     :param activation_cache: contains Z (stored during the forward propagation)
     :return: gradient of the cost with respect to Z
     """
-    dZ = np.array(dA, copy=True)
-    dZ[activation_cache <= 0] = 0
-    return dZ
+    dA[activation_cache <= 0] = 0
+    return dA
 
 
 def softmax_backward(dA, activation_cache):
@@ -236,7 +344,7 @@ def softmax_backward(dA, activation_cache):
     return np.subtract(dA, activation_cache)
 
 
-def L_model_backward(AL, Y, caches, dropout):
+def L_model_backward(AL, Y, caches, dropout, buffers=None):
     """
     Implement the backward propagation process for the entire network.
     :param AL: - the probabilities vector, the output of the forward propagation
@@ -244,57 +352,132 @@ def L_model_backward(AL, Y, caches, dropout):
     :param Y: the true labels vector (the "ground truth" - true classifications)
     :param caches: list of caches containing for each layer:
     a) the linear cache;
-    b) the activation cache
+    b) the activation cache;
+    c) for relu layers, the dropout mask (or None)
+    :param buffers: optional preallocated arrays (from initialize_buffers)
+    that the gradients are written into
     :return:
-    Grads - a dictionary with the gradients
-             grads["dA" + str(l)] = ...
-             grads["dW" + str(l)] = ...
-             grads["db" + str(l)] = ...
+    grads - a tuple (dWs, dbs) of two lists with the gradients of each layer,
+    parallel to the (Ws, bs) parameter lists
     """
-    grads = {}
-    dropout_cache = {}
     layers = len(caches)
-    if dropout < 1:
-        dropout_cache = {'prob': dropout, 'cache': caches[layers-2][2]}
-
-    last_cache_plus_Y = [i for i in caches[layers - 1]]
-    last_cache_plus_Y.append(Y)
-    dA_prev, dW, db = linear_activation_backward(AL, last_cache_plus_Y, "softmax", dropout, dropout_cache)
-    grads["dA" + str(layers-1)] = dA_prev
-    grads["dW" + str(layers)] = dW
-    grads["db" + str(layers)] = db
+    dWs = [None] * layers
+    dbs = [None] * layers
+    # masks[l] is the dropout mask applied to the input of layer l
+    masks = [None] + [cache[2] for cache in caches[:-1]]
+    if buffers is not None:
+        outs = list(zip(buffers["dA_prev"], buffers["dW"], buffers["db"]))
+    else:
+        outs = [None] * layers
+
+    dA_prev, dW, db = linear_activation_backward(AL, caches[layers - 1], "softmax", dropout, masks[layers - 1], Y=Y,
+                                                 out=outs[layers - 1], need_dA_prev=layers > 1)
+    dWs[layers - 1] = dW
+    dbs[layers - 1] = db
     for l in reversed(range(layers-1)):
-        if dropout < 1 and l - 2 > 0:
-            dropout_cache = {'prob': dropout, 'cache': caches[l - 2][2]}
-        else:
-            dropout_cache = {}
-        dA_prev, dW, db = linear_activation_backward(grads["dA" + str(l + 1)], caches[l], "relu", dropout, dropout_cache)
-        grads["dA" + str(l)] = dA_prev
-        grads["dW" + str(l+1)] = dW
-        grads["db" + str(l+1)] = db
+        dA_prev, dW, db = linear_activation_backward(dA_prev, caches[l], "relu", dropout, masks[l], out=outs[l],
+                                                     need_dA_prev=l > 0)
+        dWs[l] = dW
+        dbs[l] = db
 
-    return grads
+    return dWs, dbs
 
 
-def Update_parameters(parameters, grads, learning_rate):
+def Update_parameters(parameters, grads, learning_rate, scratch=None):
     """
-    Updates parameters using gradient descent
-    :param parameters: a python dictionary containing the DNN architecture’s
+    Updates parameters using gradient descent. Kept because the assignment
+    requires this function; L_layer_model trains with Update_flat_parameters,
+    which updates all the layers with one operation on the flat buffer
+    :param parameters: the (Ws, bs) lists of the DNN architecture’s
     parameters
-    :param grads: a python dictionary containing the gradients
+    :param grads: the (dWs, dbs) lists of the gradients
     (generated by L_model_backward)
     :param learning_rate: the learning rate used to update the parameters
     (the “alpha”)
+    :param scratch: optional (Ws, bs) shaped buffers that hold the scaled
+    gradients, so repeated updates do not allocate new arrays
     :return: parameters – the updated values of the parameters object
     provided as input
     """
-    for l in range(1, len(parameters)+1):
-        parameters[l][0] = parameters[l][0] - (learning_rate * grads["dW" + str(l)])
-        parameters[l][1] = parameters[l][1] - (learning_rate * grads["db" + str(l)])
+    Ws, bs = parameters
+    dWs, dbs = grads
+    if scratch is None:
+        scratch = ([np.empty_like(W) for W in Ws], [np.empty_like(b) for b in bs])
+    tmp_Ws, tmp_bs = scratch
+    for l in range(len(Ws)):
+        np.multiply(dWs[l], learning_rate, out=tmp_Ws[l])
+        np.subtract(Ws[l], tmp_Ws[l], out=Ws[l])
+        np.multiply(dbs[l], learning_rate, out=tmp_bs[l])
+        np.subtract(bs[l], tmp_bs[l], out=bs[l])
 
     return parameters
 
 
+def Update_flat_parameters(params_buffer, grads_buffer, learning_rate, scratch=None):
+    """
+    Updates all the parameters with a single gradient descent step over the
+    flat buffers that the per-layer W/b and dW/db arrays are views into
+    :param params_buffer: the flat parameters buffer (see parameter_views)
+    :param grads_buffer: the flat gradients buffer, laid out like params_buffer
+    :param learning_rate: the learning rate used to update the parameters
+    (the “alpha”)
+    :param scratch: optional buffer shaped like params_buffer that holds the
+    scaled gradients
+    :return: params_buffer – updated in place
+    """
+    if scratch is None:
+        scratch = np.empty_like(params_buffer)
+    np.multiply(grads_buffer, learning_rate, out=scratch)
+    np.subtract(params_buffer, scratch, out=params_buffer)
+    return params_buffer
+
+
+def make_jax_step(parameters, learning_rate):
+    """
+    Builds an XLA-compiled training step (forward, backward and SGD update) for
+    the [LINEAR->RELU]*(L-1)->LINEAR->SOFTMAX network (no batchnorm, no dropout).
+    The trained values stay on the JAX device between steps
+    :param parameters: the (Ws, bs) lists of NumPy parameters to train
+    :param learning_rate: the learning rate used to update the parameters
+    :return: step – a function (X, Y) that runs one step on the batch,
+    sync – a function that copies the trained values back into the NumPy
+    parameters in place (call it before the NumPy parameters are read)
+    """
+    import jax
+    import jax.numpy as jnp
+
+    def forward(params, X):
+        A = X
+        for W, b in params[:-1]:
+            A = jnp.maximum(W @ A + b, 0)
+        W, b = params[-1]
+        return W @ A + b
+
+    def loss(params, X, Y):
+        # softmax cross-entropy computed from the logits
+        Z = forward(params, X)
+        return jnp.mean(jax.nn.logsumexp(Z, axis=0) - jnp.sum(Y * Z, axis=0))
+
+    @jax.jit
+    def update(params, X, Y):
+        grads = jax.grad(loss)(params, X, Y)
+        return jax.tree_util.tree_map(lambda p, g: p - learning_rate * g, params, grads)
+
+    Ws, bs = parameters
+    jax_params = [(jnp.asarray(W), jnp.asarray(b)) for W, b in zip(Ws, bs)]
+
+    def step(X, Y):
+        nonlocal jax_params
+        jax_params = update(jax_params, X, Y)
+
+    def sync():
+        for W, b, (jax_W, jax_b) in zip(Ws, bs, jax_params):
+            np.copyto(W, np.asarray(jax_W))
+            np.copyto(b, np.asarray(jax_b))
+
+    return step, sync
+
+
 def plot(train_results, val_results, title, y_label, batch_size, use_batchnorm, dropout):
     """
     :param train_results
@@ -314,7 +497,8 @@ def plot(train_results, val_results, title, y_label, batch_size, use_batchnorm,
     plt.show()
 
 
-def L_layer_model(X, Y, layers_dims, learning_rate, num_iterations, batch_size, use_batchnorm, dropout):
+def L_layer_model(X, Y, layers_dims, learning_rate, num_iterations, batch_size, use_batchnorm, dropout,
+                  use_jax=False):
     """
     Implements a L-layer neural network. All layers but the last should have the
     ReLU activation function, and the final layer will apply the softmax
@@ -331,10 +515,14 @@ def L_layer_model(X, Y, layers_dims, learning_rate, num_iterations, batch_size,
     :param learning_rate: the value to "jump" in every gradient decent iteration
     :param num_iterations: the total number of iteration.
     :param batch_size: the number of examples in a single training batch.
+    :param use_jax: run each training step as a single XLA-compiled JAX
+    function (requires jax, no batchnorm and no dropout)
     :return:
     the parameters learnt by the system during the training
-    (the same parameters that were updated in the update_parameters function).
-    the values of the cost function (calculated by the compute_cost function).
+    (updated in place by the Update_flat_parameters function, or copied back
+    from the JAX step when use_jax=True).
+    the values of the cost function (calculated by the compute_cost function,
+    from the logits of the training batch, the same way as the validation cost).
     One value is to be saved after each 100 training iterations (e.g. 3000 iterations -> 30 values).
     """
     costs = []
@@ -342,34 +530,55 @@ def L_layer_model(X, Y, layers_dims, learning_rate, num_iterations, batch_size,
     accuracy_train_list = []
     accuracy_val = []
     last_cost_val = 100
-    parameters = initialize_parameters(layers_dims)
+    params_buffer = np.empty(count_parameters(layers_dims), dtype=np.float32)
+    parameters = initialize_parameters(layers_dims, params_buffer)
+    scratch = np.empty_like(params_buffer)
     X_train, X_val, y_train, y_val = train_test_split(X.T, Y.T, test_size=0.2, random_state=42)
+    # Fortran order keeps every column slice (batch) contiguous for BLAS
+    X_train = np.asfortranarray(X_train.T)
+    y_train = np.asfortranarray(y_train.T)
+    X_val = np.asfortranarray(X_val.T)
+    y_val = np.asfortranarray(y_val.T)
+    buffers = initialize_buffers(layers_dims, batch_size)
+    buffers_val = initialize_buffers(layers_dims, X_val.shape[1], with_gradients=False)
+    if use_jax:
+        if use_batchnorm or dropout < 1:
+            raise ValueError("the JAX training step supports neither batchnorm nor dropout")
+        jax_step, jax_sync = make_jax_step(parameters, learning_rate)
     num_epochs = num_iterations
     iteration = 0
     for epoch in range(num_epochs):
         print(f'Epoch:{epoch}')
-        for batch in range(int(len(y_train) / batch_size)):
+        perm = np.random.permutation(X_train.shape[1])
+        X_shuffled = np.asfortranarray(X_train[:, perm])
+        y_shuffled = np.asfortranarray(y_train[:, perm])
+        for batch in range(int(y_train.shape[1] / batch_size)):
 
             starting_sample = batch * batch_size
             ending_sample = starting_sample + batch_size
-            A, cache_list = L_model_forward(X_train[starting_sample:ending_sample].T, parameters, use_batchnorm, dropout)
-
-            grads = L_model_backward(A, y_train[
-                                        starting_sample:ending_sample].T,
-                                     cache_list, dropout)
-            parameters = Update_parameters(parameters, grads, learning_rate)
+            X_batch = X_shuffled[:, starting_sample:ending_sample]
+            y_batch = y_shuffled[:, starting_sample:ending_sample]
+            if use_jax:
+                jax_step(X_batch, y_batch)
+            else:
+                A, cache_list = L_model_forward(X_batch, parameters, use_batchnorm, dropout, buffers=buffers)
+
+                # the gradients are written into buffers["grads"] (Linear_backward
+                # raises if they are not), which is laid out like params_buffer
+                L_model_backward(A, y_batch, cache_list, dropout, buffers)
+                Update_flat_parameters(params_buffer, buffers["grads"], learning_rate, scratch)
 
             if iteration % 100 == 0:
-                costs.append((iteration, compute_cost(A, y_train[starting_sample:ending_sample].T)))
-
-                A_val, cache_list_val = L_model_forward(X_val.T, parameters, use_batchnorm, 1)
-                cost_val = compute_cost(A_val, y_val.T)
-                costs_val.append((iteration, cost_val))
-
-                accuracy_train = Predict(X_train[starting_sample:ending_sample].T, y_train[starting_sample:ending_sample].T, parameters, use_batchnorm)
+                if use_jax:
+                    jax_sync()
+                # both curves are evaluated the same way (from the logits,
+                # without dropout) so they can be compared on one plot
+                cost_train, accuracy_train = eval_model(X_batch, y_batch, parameters, use_batchnorm, buffers)
+                costs.append((iteration, cost_train))
                 accuracy_train_list.append((iteration, accuracy_train))
 
-                accuracy = Predict(X_val.T, y_val.T, parameters, use_batchnorm)
+                cost_val, accuracy = eval_model(X_val, y_val, parameters, use_batchnorm, buffers_val)
+                costs_val.append((iteration, cost_val))
                 accuracy_val.append((iteration, accuracy))
 
                 print(f"iteration {iteration}, cost_val {cost_val}, accuracy {accuracy}")
@@ -377,13 +586,15 @@ def L_layer_model(X, Y, layers_dims, learning_rate, num_iterations, batch_size,
                     print(f"early stopping after {iteration}")
                     plot(costs, costs_val, "Train validation cost", "Cost", batch_size, use_batchnorm, dropout)
                     plot(accuracy_train_list, accuracy_val, "Train validation accuracy", "Accuracy", batch_size, use_batchnorm, dropout)
-                    accuracy_final_train = Predict(X_train.T, y_train.T, parameters, use_batchnorm)
-                    accuracy_final_val = Predict(X_val.T, y_val.T, parameters, use_batchnorm)
+                    accuracy_final_train = Predict(X_train, y_train, parameters, use_batchnorm)
+                    accuracy_final_val = Predict(X_val, y_val, parameters, use_batchnorm)
                     print(f"training accuracy: {accuracy_final_train}")
                     print(f"validation accuracy: {accuracy_final_val}")
                     return parameters, costs
                 last_cost_val = cost_val
             iteration += 1
+    if use_jax:
+        jax_sync()
     plot(costs, costs_val, "Train validation cost", "Cost", batch_size, use_batchnorm, dropout)
     plot(accuracy_train_list, accuracy_val, "Train validation accuracy", "Accuracy", batch_size, use_batchnorm, dropout)
 
@@ -397,7 +608,7 @@ def Predict(X, Y, parameters, use_batchnorm):
     :param X: the input data, a numpy array of shape (height*width, number_of_examples)
     :param Y: the “real” labels of the data, a vector of shape
     (num_of_classes, number of examples)
-    :param parameters: a python dictionary containing the DNN
+    :param parameters: the (Ws, bs) lists of the DNN
     architecture’s parameters
     :return:
     accuracy – the accuracy measure of the neural net on the provided data
@@ -407,21 +618,36 @@ def Predict(X, Y, parameters, use_batchnorm):
     """
 
     AL, caches = L_model_forward(X, parameters, use_batchnorm, 1)
-    AL = softmax(AL)[0]
-    acc = 0
-    for i in range(AL.shape[1]):
-        tmp_AL = max(enumerate(AL[:, i]), key=operator.itemgetter(1))[0]
-        tmp_Y = max(enumerate(Y[:, i]), key=operator.itemgetter(1))[0]
-        if tmp_AL == tmp_Y:
-            acc += 1
-    return (acc / Y.shape[1])*100
+    pred = np.argmax(AL, axis=0)
+    true = np.argmax(Y, axis=0)
+    return float(np.mean(pred == true)) * 100
+
+
+def eval_model(X, Y, parameters, use_batchnorm, buffers=None):
+    """
+    Calculates both the cost and the accuracy of the network on the data
+    using a single forward pass.
+    :param X: the input data, a numpy array of shape (height*width, number_of_examples)
+    :param Y: the “real” labels of the data, a vector of shape
+    (num_of_classes, number of examples)
+    :param parameters: the (Ws, bs) lists of the DNN
+    architecture’s parameters
+    :param use_batchnorm: True/False
+    :param buffers: optional preallocated forward buffers sized for X
+    :return:
+    cost – the cross-entropy cost on the data
+    accuracy – the accuracy measure of the neural net on the data (as in Predict)
+    """
+    Z, caches = L_model_forward(X, parameters, use_batchnorm, 1, return_logits=True, buffers=buffers)
+    accuracy = float(np.mean(np.argmax(Z, axis=0) == np.argmax(Y, axis=0))) * 100
+    return compute_cost(Z, Y, from_logits=True), accuracy
 
 
 if __name__ == '__main__':
     data = tf.keras.datasets.mnist.load_data()
     (train_images, train_labels), (test_images, test_labels) = data
-    train_labels = np_utils.to_categorical(train_labels, 10)
-    test_labels = np_utils.to_categorical(test_labels, 10)
+    train_labels = np_utils.to_categorical(train_labels, 10).astype(np.float32)
+    test_labels = np_utils.to_categorical(test_labels, 10).astype(np.float32)
     layers = [784, 20, 7, 5, 10]
     learning_rate = 0.009
     num_iterations = 3000
@@ -432,8 +658,8 @@ if __name__ == '__main__':
     train_images_flat = train_images.reshape(train_images.shape[0], -1)
     test_images_flat = test_images.reshape(test_images.shape[0], -1)
 
-    train_images_norm = np.divide(train_images_flat, 255)
-    test_images_norm = np.divide(test_images_flat, 255)
+    train_images_norm = np.divide(train_images_flat, 255).astype(np.float32)
+    test_images_norm = np.divide(test_images_flat, 255).astype(np.float32)
     start_time = time.time()
     parameters, costs = L_layer_model(train_images_norm.T, train_labels.T, layers, learning_rate, num_iterations, batch_size, use_batchnorm, dropout)
     run_time = (time.time() - start_time) / 60